@@ -25,6 +25,10 @@ Prerequisites
 	- U{Python 2.7.X<https://www.python.org/downloads/release/python-279/>}
 	- U{Numpy<http://www.numpy.org/>}
 	- U{Requests<http://docs.python-requests.org/en/latest/>}
+	- U{Blosc<http://python-blosc.blosc.org/>} (optional, for faster
+	compression of saved datasets)
+	- U{pandas<http://pandas.pydata.org/>} (optional, for faster loading
+	of non-numeric CSVs)
 
 Installation
 ============
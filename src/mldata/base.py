@@ -19,16 +19,38 @@ G{packagetree mldata}
 __docformat__ = 'epytext'
 
 # Native imports
-import os, cPickle, csv, shutil
+import os, csv, shutil
+from itertools import izip
 from abc import ABCMeta, abstractmethod
+from cStringIO import StringIO
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 # Third party imports
 import numpy as np
+import requests
 
 # Program imports
-from mldata.util import downloader, extractor, load_pkl
+from mldata.util import downloader, extractor, dump_pkl, load_pkl,          \
+	IO_BUFFER_SIZE
 from mldata.exception_handler import BaseException, wrap_error
 
+# Constant - Denoting the CSV formatting of each 8-bit unsigned value. Every
+# value is packed into a 4 byte word containing its right aligned digits and a
+# comma. The corresponding mask denotes which of those bytes are used.
+UINT8_CSV_WORDS = np.array([np.frombuffer('{0:3},'.format(i), np.uint8) for i
+	in xrange(256)]).view('<u4').ravel()
+UINT8_CSV_MASKS = np.array([(i >= 100, i >= 10, True, True) for i in
+	xrange(256)]).view('<u4').ravel()
+
+# Constant - Denoting the maximum number of chunks of CSV rows that are
+# formatted at once
+CSV_MAX_CHUNKS = 4
+
+# The saved datasets found in each user directory, along with the
+# modification time of the directory when it was scanned
+_user_saves = {}
+
 ###############################################################################
 ########## Exception Handling
 ###############################################################################
@@ -51,6 +73,44 @@ class InvalidSavedDataset(BaseException):
 			'current saved datasets are {1}'.format(name, ', '.join(map(str,
 				datasets))))
 
+class InvalidSelectionAmount(BaseException):
+	"""
+	Exception if the number of items to reduce the dataset by is too small or
+	too large.
+	"""
+	
+	def __init__(self, desired, limit, type):
+		"""
+		Initialize this class.
+		
+		@param desired: The user-desired limit amount.
+		
+		@param limit: The actual limit.
+		
+		@param type: The category, i.e. 'train' or 'test'
+		"""
+		
+		self.msg = wrap_error('The requested number of {0} items, {1}, is '
+			'invalid. The amount must be greater than 0 and less than {2}'    \
+			.format(type, desired, limit))
+
+class UnknownTestLabels(BaseException):
+	"""
+	Exception if the test set contains labels that are not in the training
+	set.
+	"""
+	
+	def __init__(self, labels):
+		"""
+		Initialize this class.
+		
+		@param labels: A list of the unknown labels.
+		"""
+		
+		self.msg = wrap_error('The test set contains the labels {0}, which do '
+			'not occur in the training set.'.format(', '.join(map(str,
+				labels))))
+
 ###############################################################################
 ########## Class Implementation
 ###############################################################################
@@ -87,7 +147,7 @@ class BaseDataset(object):
 		not.
 		"""
 	
-	def _csv_dump(self, path, header, x, y=None, iters=1):
+	def _csv_dump(self, path, header, x, y=None, iters=1, batch_size=10000):
 		"""
 		Output the data to a CSV, with or without labels.
 		
@@ -102,18 +162,193 @@ class BaseDataset(object):
 		@param iters: The number of times to duplicate the data. If this value
 		is larger than one, using this data set will simulate running multiple
 		epochs.
+		
+		@param batch_size: The number of rows to pass to the CSV writer at a
+		time, when a NumPy matrix cannot be written with the fast integer
+		path.
 		"""
 		
-		with open(path, 'wb') as f:
+		with open(path, 'wb', IO_BUFFER_SIZE) as f:
 			writer = csv.writer(f)
 			if len(header) > 0:
 				writer.writerow(header)
-			for iter in xrange(iters):
-				for i, item in enumerate(x):
-					if y is not None:
-						writer.writerow([y[i]] + list(item))
-					else:
-						writer.writerow(item)
+			
+			# When duplicating the data, format it only once
+			out    = f if iters == 1 else StringIO()
+			writer = csv.writer(out)
+			
+			if self._is_int_matrix(x, y):
+				self._csv_dump_numeric(out, writer.dialect, x, y)
+			else:
+				self._csv_dump_generic(writer, x, y, batch_size)
+			
+			if iters > 1:
+				body = out.getvalue()
+				for iter in xrange(iters):
+					f.write(body)
+	
+	def _csv_dump_numeric(self, f, dialect, x, y=None):
+		"""
+		Output integer data to a CSV. The data is formatted entirely by NumPy,
+		with chunks of rows being formatted in parallel, as NumPy releases the
+		GIL. Each chunk formats about IO_BUFFER_SIZE bytes of output and at
+		most CSV_MAX_CHUNKS chunks are formatted at once, so the memory used
+		does not depend on the data type or the number of CPUs.
+		
+		@param f: The file to write to.
+		
+		@param dialect: The CSV dialect to format the data with.
+		
+		@param x: The x data.
+		
+		@param y: The y data.
+		"""
+		
+		data   = x if y is None else np.column_stack((y, x))
+		info   = np.iinfo(data.dtype)
+		width  = max(len(str(info.min)), len(str(info.max))) + 1
+		chunk  = max(1, IO_BUFFER_SIZE // (width * max(1, data.shape[1])))
+		chunks = [data[i:i + chunk] for i in xrange(0, len(data), chunk)]
+		def format_rows(rows):
+			"""
+			Format the rows using the dialect.
+			
+			@param rows: The rows to format.
+			
+			@return: A string containing the formatted rows.
+			"""
+			
+			return self._format_int_rows(rows, dialect.delimiter,
+				dialect.lineterminator)
+		
+		n_workers = min(cpu_count(), CSV_MAX_CHUNKS)
+		if n_workers == 1:
+			for rows in chunks:
+				f.write(format_rows(rows))
+		else:
+			pool = ThreadPool(n_workers)
+			try:
+				for i in xrange(0, len(chunks), n_workers):
+					for s in pool.map(format_rows, chunks[i:i + n_workers]):
+						f.write(s)
+			finally:
+				pool.close()
+	
+	def _csv_dump_generic(self, writer, x, y=None, batch_size=10000):
+		"""
+		Output any other data to a CSV, using the CSV writer.
+		
+		@param writer: The CSV writer to write with.
+		
+		@param x: The x data.
+		
+		@param y: The y data.
+		
+		@param batch_size: The number of rows of a NumPy matrix to pass to the
+		CSV writer at a time.
+		"""
+		
+		if isinstance(x, np.ndarray) and x.ndim == 2 and                      \
+			issubclass(x.dtype.type, (float, basestring)) and                 \
+			(y is None or np.asarray(y).dtype == x.dtype):
+			# Other matrices can be combined at once if the labels have the
+			# same type. Only types whose Python equivalents (as returned by
+			# "tolist") are written the same as the NumPy scalars are used.
+			data = x if y is None else np.column_stack((y, x))
+			for i in xrange(0, len(data), batch_size):
+				writer.writerows(data[i:i + batch_size].tolist())
+		elif y is None:
+			writer.writerows(x)
+		else:
+			writer.writerows((label,) + tuple(item) for label, item in
+				izip(y, x))
+	
+	def _format_int_rows(self, data, delimiter=',', newline='\r\n'):
+		"""
+		Format an integer matrix as CSV rows. Every value is given a fixed
+		width slot containing its sign, its digits, and the following
+		separator. The slots are computed for all values at once, and the
+		unused bytes (the sign of non-negative values, leading zeros, and the
+		unused part of the separator) are then masked out.
+		
+		@param data: A 2D integer array.
+		
+		@param delimiter: The string separating each value.
+		
+		@param newline: The string terminating each row.
+		
+		@return: A string containing the formatted rows.
+		"""
+		
+		n_rows, n_cols = data.shape
+		if data.size == 0:
+			return newline * n_rows
+		
+		# 8-bit data is formatted with a lookup table, using one word per value
+		if data.dtype == np.uint8 and delimiter == ',' and len(newline) <= 4:
+			words = np.empty((n_rows, n_cols + 1), '<u4')
+			masks = np.empty((n_rows, n_cols + 1), '<u4')
+			UINT8_CSV_WORDS.take(data, out=words[:, :-1])
+			UINT8_CSV_MASKS.take(data, out=masks[:, :-1])
+			words[:, -1] = np.frombuffer(newline.ljust(4), '<u4')[0]
+			masks[:, -1] = np.array([i < len(newline) for i in xrange(4)])    \
+				.view('<u4')[0]
+			keep = masks.view(bool)
+			keep[:, 4 * n_cols - 1] = False
+			return words.view(np.uint8)[keep].tostring()
+		
+		# Find the magnitude of each value. The absolute value is reinterpreted
+		# as unsigned, so that the most negative value is also handled.
+		if data.dtype.kind == 'u':
+			mag = data
+		else:
+			mag = np.abs(data).view(data.dtype.str.replace('i', 'u'))
+		n_digits = len(str(mag.max()))
+		sep_size = max(len(delimiter), len(newline))
+		slots    = np.empty((n_rows, n_cols, n_digits + 1 + sep_size),
+			np.uint8)
+		keep     = np.zeros(slots.shape, bool)
+		
+		# Sign
+		slots[..., 0] = ord('-')
+		keep[..., 0]  = data < 0
+		
+		# Digits, with the leading zeros removed
+		for i in xrange(n_digits):
+			p = mag.dtype.type(10 ** (n_digits - 1 - i))
+			slots[..., i + 1] = mag // p % 10 + ord('0')
+			keep[..., i + 1]  = mag >= p
+		keep[..., n_digits] = True
+		
+		# Separators
+		sep = np.frombuffer(delimiter.ljust(sep_size), np.uint8)
+		end = np.frombuffer(newline.ljust(sep_size), np.uint8)
+		slots[:, :-1, n_digits + 1:] = sep
+		keep[:, :-1, n_digits + 1:n_digits + 1 + len(delimiter)] = True
+		slots[:, -1, n_digits + 1:] = end
+		keep[:, -1, n_digits + 1:n_digits + 1 + len(newline)]    = True
+		
+		return slots[keep].tostring()
+	
+	def _is_int_matrix(self, x, y=None):
+		"""
+		Determine if the data may be written using the fast integer path.
+		
+		@param x: The x data.
+		
+		@param y: The y data.
+		
+		@return: True if x is a 2D integer array and y is either None or a 1D
+		integer array, otherwise False.
+		"""
+		
+		if not isinstance(x, np.ndarray) or x.ndim != 2 or                    \
+			x.dtype.kind not in 'iu':
+			return False
+		if y is None:
+			return True
+		y = np.asarray(y)
+		return y.ndim == 1 and y.dtype.kind in 'iu'
 	
 	def _get_unique_labels(self):
 		"""
@@ -121,21 +356,85 @@ class BaseDataset(object):
 		of each label type. It assumes that all labels are shared between
 		training and test sets, i.e. there is at least one occurrence of each
 		label in each dataset.
+		
+		@raise UnknownTestLabels: Raised if the test set contains labels that
+		are not in the training set.
 		"""
 		
+		# Nothing needs to be recomputed if the labels have not been replaced
+		# since the last call. References to the labels are kept, so their
+		# identities cannot be reused by other arrays.
+		source = getattr(self, '_label_source', (None, None))
+		if source[0] is self.y_train and source[1] is self.y_test:
+			return
+		
 		# Find unique labels
-		self.unique_labels = set(self.y_train)
+		train_labels, train_counts = self._count_labels(self.y_train)
+		test_labels, test_counts   = self._count_labels(self.y_test)
+		self.unique_labels = train_labels
 		self.num_labels    = len(self.unique_labels)
 		
+		# Ensure that the labels are shared
+		unknown = set(test_labels).difference(train_labels)
+		if unknown:
+			raise UnknownTestLabels(sorted(unknown))
+		
 		# Find label distribution
-		self.label_train_count = {lbl:0 for lbl in self.unique_labels}
-		self.label_test_count  = {lbl:0 for lbl in self.unique_labels}
-		for lbl in self.y_train:
-			self.label_train_count[lbl] += 1
-		for lbl in self.y_test:
-			self.label_test_count[lbl] += 1
+		self.label_train_count = dict(zip(train_labels, train_counts))
+		self.label_test_count  = dict.fromkeys(train_labels, 0)
+		self.label_test_count.update(zip(test_labels, test_counts))
 		self.min_train_count = min(self.label_train_count.values())
 		self.min_test_count  = min(self.label_test_count.values())
+		self._label_source   = (self.y_train, self.y_test)
+	
+	def _count_labels(self, y):
+		"""
+		Counts the number of occurrences of each label.
+		
+		@param y: The label data.
+		
+		@return: A tuple containing a list of the sorted unique labels and a
+		list of their corresponding counts.
+		"""
+		
+		y = np.asarray(y)
+		if (y.size and y.dtype.kind in 'ui' and np.can_cast(y.dtype, np.intp)
+			and y.min() >= 0 and y.max() <= max(2 * y.size, 2 ** 16)):
+			# Small non-negative integers can be counted directly
+			counts = np.bincount(y)
+			labels = np.flatnonzero(counts)
+			counts = counts[labels]
+		else:
+			labels, counts = np.unique(y, return_counts=True)
+		
+		return labels.tolist(), counts.tolist()
+	
+	def _first_per_label(self, y, limit, labels):
+		"""
+		Finds the first occurrences of each label.
+		
+		@param y: The label data.
+		
+		@param limit: The number of occurrences of each label to select.
+		
+		@param labels: The labels to select.
+		
+		@return: The indices of the selected occurrences, in their original
+		order.
+		"""
+		
+		# Group the indices by label, keeping each group in its original order
+		y        = np.asarray(y)
+		order    = np.argsort(y, kind='mergesort')
+		sorted_y = y[order]
+		starts   = np.searchsorted(sorted_y, labels, 'left')
+		ends     = np.searchsorted(sorted_y, labels, 'right')
+		
+		idx = np.concatenate([order[s:min(s + limit, e)] for s, e in
+			zip(starts, ends)] + [np.array([], dtype=np.intp)])
+		idx.sort()
+		
+		return idx
 	
 	def _get_user_saves(self):
 		"""
@@ -144,7 +443,15 @@ class BaseDataset(object):
 		@return: A list of saved datasets.
 		"""
 		
-		return [x[:-4] for x in os.listdir(self.user_dir)]
+		# Only rescan the directory if it has changed since the last call
+		mtime = os.stat(self.user_dir).st_mtime
+		cached_mtime, saves = _user_saves.get(self.user_dir, (None, None))
+		if mtime != cached_mtime:
+			saves = sorted(x[:-4] for x in os.listdir(self.user_dir) if
+				x.endswith('.pkl'))
+			_user_saves[self.user_dir] = (mtime, saves)
+		
+		return list(saves)
 	
 	def fetch(self, refetch=False, extract=True, keep_archive=False,
 		verbose=True):
@@ -160,7 +467,8 @@ class BaseDataset(object):
 		the extracted data. This parameter is only used if extract is True.
 		
 		@param verbose: If True a status bar will be created to show the
-		download progress.
+		download progress. The status bars cannot be shared, so the URLs are
+		only downloaded concurrently if this is False.
 		"""
 		
 		# Delete any unwanted data
@@ -176,23 +484,65 @@ class BaseDataset(object):
 		except OSError:
 			pass
 		
-		for url in self.urls:
-			dl_path = os.path.join(self.raw_dir, url.split('/')[-1])
-			if not os.path.exists(dl_path):
-				# Download
-				downloader(url, dl_path, verbose=verbose)
-				
-				# Extract and delete the original archive
-				if extract:
-					extractor(dl_path, self.raw_dir)
-					if not keep_archive:
-						os.remove(dl_path)
+		# Only fetch the URLs that have not already been downloaded
+		existing = set(os.listdir(self.raw_dir))
+		urls     = [url for url in self.urls if url.rsplit('/', 1)[-1] not in
+			existing]
+		if not urls:
+			return
+		
+		# Download each URL, reusing the connections between them
+		session = requests.Session()
+		try:
+			if verbose or len(urls) < 2:
+				for url in urls:
+					self._fetch_one(url, session, extract, keep_archive,
+						verbose)
+			else:
+				pool = ThreadPool(min(8, len(urls)))
+				try:
+					pool.map(lambda url: self._fetch_one(url, session, extract,
+						keep_archive, verbose), urls)
+				finally:
+					pool.close()
+		finally:
+			session.close()
 	
-	def save(self, name):
+	def _fetch_one(self, url, session, extract=True, keep_archive=False,
+		verbose=True):
+		"""
+		Downloads and extracts a single URL.
+		
+		@param url: The URL to fetch.
+		
+		@param session: The requests session to download with.
+		
+		@param extract: If True, the data will also be extracted.
+		
+		@param keep_archive: If True, the archive will be kept in addition to
+		the extracted data. This parameter is only used if extract is True.
+		
+		@param verbose: If True a status bar will be created to show the
+		download progress.
+		"""
+		
+		# Download
+		dl_path = os.path.join(self.raw_dir, url.rsplit('/', 1)[-1])
+		downloader(url, dl_path, verbose=verbose, session=session)
+		
+		# Extract and delete the original archive
+		if extract:
+			extractor(dl_path, self.raw_dir)
+			if not keep_archive:
+				os.remove(dl_path)
+	
+	def save(self, name, compressed=False):
 		"""
 		Saves the data as a custom dataset.
 		
 		@param name: The name to save the data as.
+		
+		@param compressed: If True, the data will be compressed.
 		"""
 		
 		path = os.path.join(self.user_dir, name + '.pkl')
@@ -201,15 +551,19 @@ class BaseDataset(object):
 		except OSError:
 			pass
 		
-		self.dump_pkl(path)
+		self.dump_pkl(path, compressed)
 	
-	def load(self, name=None):
+	def load(self, name=None, mmap_mode=None):
 		"""
 		Loads the saved data.
 		
 		@param name: The name of the saved data to load. If None, the default
 		base set will be used.
 		
+		@param mmap_mode: If not None, the data will be memory-mapped using
+		this mode (e.g. 'r') instead of being read into memory. This only
+		applies to uncompressed saves.
+		
 		@raise InvalidSavedDataset: Raised if the saved dataset does not exist.
 		"""
 		
@@ -220,19 +574,26 @@ class BaseDataset(object):
 			if not os.path.isfile(path):
 				raise InvalidSavedDataset(path, self._get_user_saves())
 		
-		(self.x_train, self.y_train), (self.x_test, self.y_test) =            \
-			load_pkl(path)
+		(x_train, y_train), (x_test, y_test) = load_pkl(path, mmap_mode)
+		
+		# Always store the data as arrays, regardless of how it was saved
+		self.x_train, self.y_train, self.x_test, self.y_test = [np.asarray(a)
+			for a in (x_train, y_train, x_test, y_test)]
 		
 		# Extract properties about the data
 		self._get_unique_labels()
 		
-	def dump_pkl(self, out_path):
+	def dump_pkl(self, out_path, compressed=False):
 		"""
-		Output the data to a pickled data file. The data will be in the format
-		of a list of two lists. The inner lists will contain the images and the
+		Output the data to a data file. The data will be in the format of a
+		list of two lists. The inner lists will contain the images and the
 		labels, respectively, for the training and testing data, respectively.
+		The file is not a plain pickle; it can only be read back with
+		"mldata.util.load_pkl".
 		
 		@param out_path: The destination of where to write the file.
+		
+		@param compressed: If True, the data will be compressed.
 		"""
 		
 		try:
@@ -240,26 +601,31 @@ class BaseDataset(object):
 		except OSError:
 			pass
 		
-		with open(out_path, 'wb') as f:
-			cPickle.dump([[self.x_train, self.y_train], [self.x_test,
-				self.y_test]], f, cPickle.HIGHEST_PROTOCOL)
+		# Store each array as a single row-major block, so that rows are
+		# contiguous when the data is later memory-mapped
+		x_train, y_train, x_test, y_test = [np.ascontiguousarray(a) for a in
+			(self.x_train, self.y_train, self.x_test, self.y_test)]
+		
+		dump_pkl([[x_train, y_train], [x_test, y_test]], out_path, compressed)
 	
 	def shuffle(self):
 		"""
-		Randomly shuffles the training and test data.
+		Randomly shuffles the training and test data. A single permutation is
+		used for both the data and the labels of each set. The global NumPy
+		random state is not modified.
 		"""
 		
+		rng = np.random.RandomState(self.seed)
+		
 		# Shuffle the training sets
-		np.random.seed(self.seed)
-		np.random.shuffle(self.x_train)
-		np.random.seed(self.seed)
-		np.random.shuffle(self.y_train)
+		perm = rng.permutation(len(self.x_train))
+		self.x_train = self.x_train[perm]
+		self.y_train = self.y_train[perm]
 		
 		# Shuffle the test sets
-		seed = np.random.get_state()[1][0]
-		np.random.shuffle(self.x_test)
-		np.random.seed(seed)
-		np.random.shuffle(self.y_test)
+		perm = rng.permutation(len(self.x_test))
+		self.x_test = self.x_test[perm]
+		self.y_test = self.y_test[perm]
 	
 	def reduce_dataset(self, n_train, n_test, normalize=True):
 		"""
@@ -318,23 +684,9 @@ class BaseDataset(object):
 			@returns: A tuple of the new data and its corresponding labels.
 			"""
 			
-			# Keep track of label occurrences
-			count  = {lbl:0 for lbl in self.unique_labels}
-			s_x    = list(x.shape); s_y = list(y.shape)
-			s_x[0] = limit * self.num_labels; s_y[0] = limit * self.num_labels
-			o_x    = np.zeros(s_x, x.dtype); o_y = np.zeros(s_y, y.dtype)
+			idx = self._first_per_label(y, limit, self.unique_labels)
 			
-			# Pull out data
-			tot = 0
-			for i, lbl in enumerate(y):
-				c = count[lbl]
-				if c < limit:
-					o_x[tot]   = x[i]
-					o_y[tot]   = lbl
-					count[lbl] += 1
-					tot        += 1
-			
-			return o_x, o_y
+			return x[idx], y[idx]
 		
 		# Only add data where we are selecting at least one point
 		if n_train > 0:
@@ -352,7 +704,7 @@ class BaseDataset(object):
 				self.x_test, self.y_test = reduce_set(self.x_test, self.y_test,
 					n_test)
 			else:
-				self.x_train = self.x_train[:n_train]
-				self.y_train = self.y_train[:n_train]
+				self.x_test = self.x_test[:n_test]
+				self.y_test = self.y_test[:n_test]
 		else:
 			self.x_test = np.array([]); self.y_test = np.array([])
\ No newline at end of file
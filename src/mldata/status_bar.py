@@ -84,6 +84,7 @@ class StatusBar(object):
 		self.style          = style
 		self.position       = 0
 		self.percent_length = 3
+		self.last_render    = None
 		
 		# Ensure that the minimum bar length isn't too small
 		if self.min_bar_length < 0:
@@ -101,6 +102,10 @@ class StatusBar(object):
 		if (len(style) != 3) or (sum([len(x) for x in style]) != 3):
 			self.style = ('[','=',']')
 		
+		# Build every possible bar up front
+		self.bars = [self.style[1] * i for i in xrange(max(self.bar_length,
+			self.max_bar_length) + 1)]
+		
 	def increment(self, step_size=1):
 		"""
 		Increments the bars position by the specified amount.
@@ -141,8 +146,14 @@ class StatusBar(object):
 				if self.bar_length < self.min_bar_length:
 					raise StatusBarLengthTooSmallError(self)
 		
+		# Only redraw the status bar if it has changed
+		render = (current_bar_length, self.bar_length, percent_progress)
+		if render == self.last_render:
+			return
+		self.last_render = render
+		
 		# Update the status bar
-		bars       = self.style[1] * current_bar_length
+		bars       = self.bars[current_bar_length]
 		bar_spaces = ' ' * (self.bar_length - current_bar_length)
 		sys.stdout.write('\r{0}{1}{2}{3} {4}%'.format(self.style[0], bars,
 			bar_spaces, self.style[2], percent_progress))
@@ -155,7 +166,8 @@ class StatusBar(object):
 		"finish" method.
 		"""
 		
-		self.position = 0
+		self.position    = 0
+		self.last_render = None
 	
 	def finish(self):
 		"""
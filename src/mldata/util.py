@@ -19,18 +19,55 @@ G{packagetree mldata}
 __docformat__ = 'epytext'
 
 # Native imports
-import cPickle, csv, zipfile, tarfile, os
+import cPickle, csv, zipfile, tarfile, os, shutil, struct, zlib, warnings
+import errno, weakref
+from cStringIO import StringIO
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from ConfigParser import SafeConfigParser, NoSectionError
 
 # Third party imports
 import numpy as np
 import requests
 
+# Optional third party imports
+try:
+	import blosc
+except ImportError:
+	blosc = None
+try:
+	import pandas as pd
+except ImportError:
+	pd = None
+
 # Program imports
 from mldata                   import BASE_DIR, USER_CFG
 from mldata.status_bar        import StatusBar
 from mldata.exception_handler import BaseException, wrap_error
 
+# Constant - Denoting the buffer size (in bytes) to use for file I/O
+IO_BUFFER_SIZE = 1024 * 1024
+
+# Constant - Denoting the identifier at the start of a dumped data file
+PKL_MAGIC = '\x93MLDATA\x01'
+
+# Constant - Denoting the supported compression codecs for dumped data files
+CODECS = (None, 'zlib', 'blosc')
+
+# Constant - Denoting the compressor and level to use with Blosc
+BLOSC_CNAME, BLOSC_CLEVEL = 'lz4', 5
+
+# Constant - Denoting the signatures found at the start of a zip file
+ZIP_MAGIC = ('PK\x03\x04', 'PK\x05\x06')
+
+# The base directory read from the user's configuration, cached on first use
+_base_dir = None
+
+# The read-only memory-mapped arrays of each loaded data file, along with the
+# identity (device and inode), modification time and size of the file when it
+# was mapped
+_mapped_arrays = {}
+
 ###############################################################################
 ########## Exception Handling
 ###############################################################################
@@ -50,6 +87,23 @@ class UnsupportedArchive(BaseException):
 		self.msg = wrap_error('The archvie, {0}, is unsupported. The archive'
 			'must be a zip or tar file.'.format(path))
 
+class UnsupportedCodec(BaseException):
+	"""
+	Exception if the compression codec is unsupported.
+	"""
+	
+	def __init__(self, path, codec):
+		"""
+		Initialize this class.
+		
+		@param path: The full path to the file.
+		
+		@param codec: The codec that was used to compress the file.
+		"""
+		
+		self.msg = wrap_error('The file, {0}, was compressed with {1}, which '
+			'is not available. Install {1} and try again.'.format(path, codec))
+
 ###############################################################################
 ########## Primary Functions
 ###############################################################################
@@ -61,14 +115,18 @@ def get_base_dir():
 	@return: The base direcotry.
 	"""
 	
-	config = SafeConfigParser()
-	config.read(USER_CFG)
+	global _base_dir
 	
-	try:
-		return config.get('global', 'base_dir')
-	except NoSectionError:
-		set_base_dir(BASE_DIR)
-		return BASE_DIR
+	if _base_dir is None:
+		config = SafeConfigParser()
+		config.read(USER_CFG)
+		
+		try:
+			_base_dir = config.get('global', 'base_dir')
+		except NoSectionError:
+			set_base_dir(BASE_DIR)
+	
+	return _base_dir
 
 def set_base_dir(base_dir):
 	"""
@@ -77,17 +135,20 @@ def set_base_dir(base_dir):
 	@param base_dir: The new base directory.
 	"""
 	
+	global _base_dir
+	
 	config = SafeConfigParser()
 	config.add_section('global')
 	config.set('global', 'base_dir', base_dir)
 	
 	with open(USER_CFG, 'wb') as f:
 		config.write(f)
+	_base_dir = base_dir
 
 def load_csv(path, x_dtype=np.dtype('uint8'), y_dtype=np.dtype('uint8'),
 	has_header=True):
 	"""
-	Get the data from a dumped CSV.
+	Get the data from a dumped CSV. Blank lines are skipped.
 	
 	@param path: The full path to the CSV.
 	
@@ -101,31 +162,305 @@ def load_csv(path, x_dtype=np.dtype('uint8'), y_dtype=np.dtype('uint8'),
 	"""
 	
 	with open(path, 'rb') as f:
+		# A header that is not ended by '\n' means that the file uses another
+		# line ending, so the whole file is left to the CSV reader
+		cr_only = has_header and '\r' in f.readline().rstrip('\r\n')
+		start   = 0 if cr_only else f.tell()
+		
+		# Parse blocks of plain numeric rows directly. The labels are parsed
+		# on their own, so that they keep the precision of their type.
+		x_dtype, y_dtype = np.dtype(x_dtype), np.dtype(y_dtype)
+		x_blocks = [] if not cr_only and x_dtype.kind in 'iuf' and            \
+			y_dtype.kind in 'iuf' else None
+		y_blocks = []
+		n_cols   = None
+		while x_blocks is not None:
+			lines = f.readlines(IO_BUFFER_SIZE)
+			if not lines:
+				break
+			lines = [line for line in lines if line.rstrip('\r\n')]
+			if not lines:
+				continue
+			
+			# Every row must have the same number of columns. Files whose
+			# lines are not ended by '\n' are left to the CSV reader.
+			if n_cols is None:
+				if not lines[0].endswith('\n'):
+					x_blocks = None
+					break
+				n_cols = lines[0].count(',') + 1
+			if any(line.count(',') != n_cols - 1 for line in lines):
+				x_blocks = None
+				break
+			
+			text = ''.join(lines).replace('\r\n', ',').replace('\n', ',')
+			with warnings.catch_warnings():
+				warnings.simplefilter('ignore')
+				data = np.fromstring(text, dtype=x_dtype, sep=',')
+			if data.size != len(lines) * n_cols:
+				x_blocks = None
+				break
+			try:
+				y = np.array([line.split(',', 1)[0].rstrip('\r\n') for line in
+					lines], dtype=y_dtype)
+			except ValueError:
+				x_blocks = None
+				break
+			x_blocks.append(data.reshape((len(lines), n_cols))[:, 1:])
+			y_blocks.append(y)
+		
+		if x_blocks is not None:
+			if not x_blocks:
+				return (np.array([]), np.array([], dtype=y_dtype))
+			return (np.concatenate(x_blocks), np.concatenate(y_blocks))
+		
+		# The file contains more than plain numbers, so fall back to a CSV
+		# reader
+		f.seek(start)
+		if pd is not None and not cr_only:
+			for line in f:
+				if line.rstrip('\r\n'):
+					break
+			else:
+				return (np.array([]), np.array([], dtype=y_dtype))
+			f.seek(start)
+			data = pd.read_csv(f, header=None, dtype=str, na_filter=False,
+				engine='c').values
+			return (data[:, 1:].astype(x_dtype), data[:, 0].astype(y_dtype))
+		
 		reader = csv.reader(f)
-		if has_header: reader.next()
+		if cr_only: next(reader, None)
 		x = []; y = []
 		for row in reader:
+			if not row: continue
 			x.append(np.array(row[1:], dtype=x_dtype))
 			y.append(row[0])
 	
 	return (np.array(x), np.array(y, dtype=y_dtype))
 
-def load_pkl(path):
+def _write_array(f, a, codec=None):
 	"""
-	Get the data from a dumped pickled data file.
+	Write an array in the NumPy (.npy) format, optionally compressing the
+	array data. A compressed array is stored as its header followed by the
+	size of the compressed data and the compressed data.
+	
+	@param f: The file to write to.
+	
+	@param a: The array to write.
+	
+	@param codec: The codec to compress the data with. If None, the data is
+	not compressed.
+	"""
+	
+	if codec is None:
+		np.lib.format.write_array(f, a, allow_pickle=False)
+		return
+	
+	a = np.ascontiguousarray(a)
+	np.lib.format.write_array_header_1_0(f,
+		np.lib.format.header_data_from_array_1_0(a))
+	if codec == 'blosc':
+		data = blosc.compress_ptr(a.__array_interface__['data'][0], a.size,
+			typesize=a.itemsize, clevel=BLOSC_CLEVEL, shuffle=blosc.BITSHUFFLE,
+			cname=BLOSC_CNAME)
+	else:
+		data = zlib.compress(a.data)
+	f.write(struct.pack('<Q', len(data)))
+	f.write(data)
+
+def _read_array(f, codec=None, mmap_mode=None):
+	"""
+	Read an array written by "_write_array".
+	
+	@param f: The file to read from.
+	
+	@param codec: The codec the data was compressed with. If None, the data is
+	not compressed.
+	
+	@param mmap_mode: If not None, the array will be memory-mapped using this
+	mode instead of being read into memory. This only applies to uncompressed
+	data.
+	
+	@return: The array.
+	"""
+	
+	if codec is None and mmap_mode is not None:
+		version = np.lib.format.read_magic(f)
+		if version == (1, 0):
+			header = np.lib.format.read_array_header_1_0(f)
+		else:
+			header = np.lib.format.read_array_header_2_0(f)
+		shape, fortran_order, dtype = header
+		offset = f.tell()
+		size   = int(np.prod(shape)) * dtype.itemsize
+		f.seek(offset + size)
+		if size == 0:
+			return np.empty(shape, dtype)
+		return np.memmap(f.name, dtype, mmap_mode, offset, shape,
+			'F' if fortran_order else 'C')
+	
+	if codec is None:
+		return np.lib.format.read_array(f, allow_pickle=False)
+	
+	np.lib.format.read_magic(f)
+	shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+	a = np.empty(shape, dtype)
+	data = f.read(struct.unpack('<Q', f.read(8))[0])
+	if codec == 'blosc':
+		blosc.decompress_ptr(data, a.__array_interface__['data'][0])
+	else:
+		memoryview(a.reshape(-1).view(np.uint8))[:] = zlib.decompress(data)
+	return a
+
+def replace_file(source_path, destination_path):
+	"""
+	Move a file into place, replacing the destination if it exists. Unlike
+	"os.rename", this also replaces the destination on Windows.
+	
+	@param source_path: The full path to the file to move.
+	
+	@param destination_path: The full path to where the file should be moved.
+	"""
+	
+	try:
+		os.rename(source_path, destination_path)
+	except OSError:
+		if not os.path.exists(destination_path):
+			raise
+		os.remove(destination_path)
+		os.rename(source_path, destination_path)
+
+def dump_pkl(data, out_path, compressed=False):
+	"""
+	Output the data to a pickled data file. Any NumPy arrays contained in the
+	data are stored out-of-band, i.e. only a reference to the array is
+	pickled and its buffer is written directly to the file after the pickle.
+	This avoids copying the array data into the pickle stream, but it means
+	that the file is not a plain pickle and can only be read back with
+	"load_pkl".
+	
+	The file consists of the magic string, the pickle length, the array count
+	and the codec, the pickle, and finally each array in the NumPy (.npy)
+	format.
+	
+	The file is written next to the destination and then moved into place, so
+	existing memory-mapped loads of the destination remain valid.
+	
+	@param data: The data to pickle.
+	
+	@param out_path: The full path to where the file should be saved.
+	
+	@param compressed: If True, the array data will be compressed. Blosc is
+	used if it is installed, otherwise zlib is used.
+	"""
+	
+	arrays = []
+	def persistent_id(obj):
+		"""
+		Store NumPy arrays out-of-band.
+		
+		@param obj: The object being pickled.
+		
+		@return: The index of the array or None if the object should be
+		pickled normally.
+		"""
+		
+		if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+			arrays.append(obj)
+			return len(arrays) - 1
+	
+	# Pickle everything but the array data
+	s = StringIO()
+	pickler = cPickle.Pickler(s, cPickle.HIGHEST_PROTOCOL)
+	pickler.persistent_id = persistent_id
+	pickler.dump(data)
+	meta = s.getvalue()
+	
+	# Determine the codec
+	if not compressed:
+		codec = None
+	elif blosc is not None:
+		codec = 'blosc'
+	else:
+		codec = 'zlib'
+	
+	tmp_path = out_path + '.tmp'
+	try:
+		with open(tmp_path, 'wb', IO_BUFFER_SIZE) as f:
+			f.write(PKL_MAGIC)
+			f.write(struct.pack('<QQB', len(meta), len(arrays),
+				CODECS.index(codec)))
+			f.write(meta)
+			for a in arrays:
+				_write_array(f, a, codec)
+		replace_file(tmp_path, out_path)
+	except:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+def load_pkl(path, mmap_mode=None):
+	"""
+	Get the data from a dumped pickled data file. Both files created by
+	"dump_pkl" and plain pickled files are supported.
 	
 	@param path: The full path to the pickled file.
 	
+	@param mmap_mode: If not None, the arrays will be memory-mapped using this
+	mode ('r', 'r+' or 'c', see "numpy.memmap") instead of being read into
+	memory. This is ignored for compressed and plain pickled files. Read-only
+	('r') mappings of an unchanged file are shared between calls for as long
+	as they are in use.
+	
 	@return: A tuple containing the data and the labels for the training and
 	test sets, i.e. (x_train, y_train), (x_test, y_test).
+	
+	@raise UnsupportedCodec: Raised if the data was compressed with a codec
+	that is not available.
+	
+	@raise ValueError: Raised if the memory-map mode is not supported. Modes
+	that create or truncate the file are not allowed.
 	"""
 	
+	if mmap_mode not in (None, 'r', 'r+', 'c'):
+		raise ValueError('Unsupported memory-map mode: %r' % (mmap_mode,))
+	
 	with open(path, 'rb') as f:
-		(x_train, y_train), (x_test, y_test) = cPickle.load(f)
+		if f.read(len(PKL_MAGIC)) != PKL_MAGIC:
+			f.seek(0)
+			(x_train, y_train), (x_test, y_test) = cPickle.load(f)
+		else:
+			meta_size, n_arrays, codec = struct.unpack('<QQB', f.read(17))
+			codec = CODECS[codec]
+			if codec == 'blosc' and blosc is None:
+				raise UnsupportedCodec(path, codec)
+			meta = f.read(meta_size)
+			
+			# Reuse the existing read-only mappings, if they are still alive
+			arrays = None
+			if codec is None and mmap_mode == 'r':
+				st    = os.fstat(f.fileno())
+				stamp = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+				key   = os.path.abspath(path)
+				cached_stamp, refs = _mapped_arrays.get(key, (None, []))
+				if cached_stamp == stamp:
+					arrays = [ref() for ref in refs]
+					if any(a is None for a in arrays):
+						arrays = None
+			
+			if arrays is None:
+				arrays = [_read_array(f, codec, mmap_mode) for _ in
+					xrange(n_arrays)]
+				if codec is None and mmap_mode == 'r':
+					_mapped_arrays[key] = (stamp, [weakref.ref(a) for a in
+						arrays])
+			unpickler = cPickle.Unpickler(StringIO(meta))
+			unpickler.persistent_load = arrays.__getitem__
+			(x_train, y_train), (x_test, y_test) = unpickler.load()
 	
 	return (x_train, y_train), (x_test, y_test)
 
-def downloader(url, out_path, chunk_size=65535, verbose=True):
+def downloader(url, out_path, chunk_size=65535, verbose=True, session=None):
 	"""
 	Download the specified item.
 	
@@ -137,10 +472,14 @@ def downloader(url, out_path, chunk_size=65535, verbose=True):
 	
 	@param verbose: If True a status bar will be created to show the download
 	progress.
+	
+	@param session: The requests session to download with, allowing its
+	connections to be reused. If None, a new connection is made.
 	"""
 	
 	# Create a new request
-	r = requests.get(url, stream=True)
+	r = (requests if session is None else session).get(url, stream=True)
+	r.raw.decode_content = True
 	
 	# Make the destination directory (if aplicable)
 	try:
@@ -154,13 +493,15 @@ def downloader(url, out_path, chunk_size=65535, verbose=True):
 		sb = StatusBar(int(r.headers['content-length']))
 	
 	# Download the file
-	with open(out_path, 'wb') as f:
+	with open(out_path, 'wb', IO_BUFFER_SIZE) as f:
+		if not verbose:
+			shutil.copyfileobj(r.raw, f, IO_BUFFER_SIZE)
+			return
 		for chunk in r.iter_content(chunk_size):
 			if chunk:
 				f.write(chunk)
-				f.flush()
-			if verbose: sb.increment(chunk_size)
-	if verbose: sb.finish()
+				sb.increment(len(chunk))
+	sb.finish()
 
 def extractor(source_path, destination_path):
 	"""
@@ -174,14 +515,24 @@ def extractor(source_path, destination_path):
 	@raise UnsupportedArchive: Raised if the archive is an unsupported type.
 	"""
 	
-	# Check to see if the archive type is supported
+	# Determine the archive type from its signature, so that only the
+	# matching reader needs to open it. Zip files may also be prefixed with
+	# other data (e.g. self-extracting archives), so those are detected from
+	# their end if the file is not a tar file.
+	with open(source_path, 'rb') as f:
+		head = f.read(4)
 	try:
-		archive = zipfile.ZipFile(source_path)
-	except zipfile.BadZipfile:
-		try:
-			archive = tarfile.open(source_path)
-		except tarfile.ReadError:
-			raise UnsupportedArchive(source_path)
+		if head.startswith(ZIP_MAGIC):
+			archive = zipfile.ZipFile(source_path, allowZip64=True)
+		else:
+			try:
+				archive = tarfile.open(source_path)
+			except tarfile.ReadError:
+				if not zipfile.is_zipfile(source_path):
+					raise
+				archive = zipfile.ZipFile(source_path, allowZip64=True)
+	except (zipfile.BadZipfile, tarfile.ReadError):
+		raise UnsupportedArchive(source_path)
 	
 	# Make the destination directory (if aplicable)
 	try:
@@ -189,5 +540,30 @@ def extractor(source_path, destination_path):
 	except OSError:
 		pass
 	
-	# Extract the archive
-	archive.extractall(destination_path)
\ No newline at end of file
+	# Extract the archive. The members of a zip file can be read
+	# independently, so they are extracted in parallel; tar files can only be
+	# read sequentially.
+	n_workers = cpu_count()
+	if isinstance(archive, zipfile.ZipFile) and n_workers > 1:
+		def extract(member):
+			"""
+			Extract a single member of the archive.
+			
+			@param member: The member to extract.
+			"""
+			
+			try:
+				archive.extract(member, destination_path)
+			except OSError, e:
+				# Another worker may have just created the same directory
+				if e.errno != errno.EEXIST:
+					raise
+				archive.extract(member, destination_path)
+		
+		pool = ThreadPool(n_workers)
+		try:
+			pool.map(extract, archive.infolist())
+		finally:
+			pool.close()
+	else:
+		archive.extractall(destination_path)
\ No newline at end of file
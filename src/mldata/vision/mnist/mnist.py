@@ -19,16 +19,31 @@ G{packagetree mldata}
 __docformat__ = 'epytext'
 
 # Native imports
-import os, struct, gzip, pkgutil, shutil
+import os, struct, gzip, pkgutil, shutil, errno
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 # Third party imports
 import numpy as np
 
 # Program imports
 from ..                       import BASE_DIR
-from mldata.base              import BaseDataset
+from mldata.base              import BaseDataset, InvalidSelectionAmount, \
+	UnknownTestLabels
+from mldata.util              import IO_BUFFER_SIZE, replace_file
 from mldata.exception_handler import BaseException, wrap_error
 
+# Constant - Denoting the header formats of the image and label files
+IMAGE_HEADER = struct.Struct('>IIII')
+LABEL_HEADER = struct.Struct('>II')
+
+# Constant - Denoting the number of rows and columns in each image
+IMAGE_SHAPE = (28, 28)
+
+# Constant - Denoting the CSV header for the 1D representation of the images
+CSV_HEADER = ['label'] + ['pixel_%d' % x for x in xrange(IMAGE_SHAPE[0] *
+	IMAGE_SHAPE[1])]
+
 ###############################################################################
 ########## Exception Handling
 ###############################################################################
@@ -54,26 +69,24 @@ class WrongMagicNumber(BaseException):
 			'{1}, but the actual magic number was {2}'.format(path, expected,
 			actual))
 
-class InvalidSelectionAmount(BaseException):
+class TruncatedFile(BaseException):
 	"""
-	Exception if the number of items to reduce the dataset by is too small or
-	too large.
+	Exception if the file contains less data than its header specifies.
 	"""
 	
-	def __init__(self, desired, limit, type):
+	def __init__(self, path, expected, actual):
 		"""
 		Initialize this class.
 		
-		@param desired: The user-desired limit amount.
+		@param path: The path to the file.
 		
-		@param limit: The actual limit.
+		@param expected: The expected number of bytes.
 		
-		@param type: The category, i.e. 'train' or 'test'
+		@param actual: The actual number of bytes.
 		"""
 		
-		self.msg = wrap_error('The requested number of {0} items, {1}, is '
-			'invalid. The amount must be greater than 0 and less than {2}'    \
-			.format(type, desired, limit))
+		self.msg = wrap_error('The file {0} should contain {1} bytes of data, '
+			'but only {2} bytes were found'.format(path, expected, actual))
 
 class InvalidDimensions(BaseException):
 	"""
@@ -113,7 +126,28 @@ class MNIST(BaseDataset):
 	Class for working with MNIST data.
 	"""
 	
-	def __init__(self, ndims=1, seed=None):
+	# The base paths, which are shared by all instances
+	raw_dir      = os.path.join(BASE_DIR, 'mnist', 'raw')
+	base_dir     = os.path.join(BASE_DIR, 'mnist', 'base')
+	user_dir     = os.path.join(BASE_DIR, 'mnist', 'user')
+	default_sets = {
+		1: os.path.join(base_dir, '1d_base.pkl'),
+		2: os.path.join(base_dir, '2d_base.pkl')
+	}
+	train_x_path = os.path.join(raw_dir, 'train-images-idx3-ubyte.gz')
+	train_y_path = os.path.join(raw_dir, 'train-labels-idx1-ubyte.gz')
+	test_x_path  = os.path.join(raw_dir, 't10k-images-idx3-ubyte.gz')
+	test_y_path  = os.path.join(raw_dir, 't10k-labels-idx1-ubyte.gz')
+	
+	# The URLs
+	urls = (
+		'http://yann.lecun.com/exdb/mnist/train-images-idx3-ubyte.gz',
+		'http://yann.lecun.com/exdb/mnist/train-labels-idx1-ubyte.gz',
+		'http://yann.lecun.com/exdb/mnist/t10k-images-idx3-ubyte.gz',
+		'http://yann.lecun.com/exdb/mnist/t10k-labels-idx1-ubyte.gz'
+	)
+	
+	def __init__(self, ndims=1, seed=None, pack_bits=False):
 		"""
 		Initializes this MNIST object. The data is automatically fetched and
 		loaded.
@@ -122,6 +156,12 @@ class MNIST(BaseDataset):
 		
 		@param seed: The seed used for all random numbers.
 		
+		@param pack_bits: If True, the images of the base set will be
+		binarized (pixels of at least 128 become 1) and packed into bits along
+		their last axis. This uses 8 times less memory. Whether images are
+		packed is determined from their shape, so packed and unpacked saves
+		may be loaded regardless of this setting.
+		
 		@raise InvalidDimensions: Raised if the number of dimensions is
 		invalid.
 		"""
@@ -131,38 +171,24 @@ class MNIST(BaseDataset):
 		if self.ndims > 2 or self.ndims < 1:
 			raise InvalidDimensions(self.ndims)
 		
-		# Set the base paths
-		self.raw_dir      = os.path.join(BASE_DIR, 'mnist', 'raw')
-		self.base_dir     = os.path.join(BASE_DIR, 'mnist', 'base')
-		self.user_dir     = os.path.join(BASE_DIR, 'mnist', 'user')
-		self.default_set  = os.path.join(self.base_dir,
-			'{0}d_base.pkl'.format(ndims))
-		self.train_x_path = os.path.join(self.raw_dir,
-			'train-images-idx3-ubyte.gz')
-		self.train_y_path = os.path.join(self.raw_dir,
-			'train-labels-idx1-ubyte.gz')
-		self.test_x_path  = os.path.join(self.raw_dir,
-			't10k-images-idx3-ubyte.gz')
-		self.test_y_path  = os.path.join(self.raw_dir,
-			't10k-labels-idx1-ubyte.gz')
-		
-		# Set the URLs
-		self.urls = (
-			'http://yann.lecun.com/exdb/mnist/train-images-idx3-ubyte.gz',
-			'http://yann.lecun.com/exdb/mnist/train-labels-idx1-ubyte.gz',
-			'http://yann.lecun.com/exdb/mnist/t10k-images-idx3-ubyte.gz',
-			'http://yann.lecun.com/exdb/mnist/t10k-labels-idx1-ubyte.gz'
-		)
+		# Set the default set for this number of dimensions
+		self.default_set = self.default_sets[ndims]
 		
 		# Set the seed for all future random numbers
 		self.seed = seed
+		
+		# Store whether the images should be packed
+		self.pack_bits = pack_bits
 	
 	def fetch(self, refetch=False, verbose=True):
 		"""
-		Downloads and loads the data.
+		Downloads and loads the data. The decompressed images are cached as
+		NumPy (.npy) files next to the raw archives, which uses about 55 MB of
+		additional disk space.
 		
 		@param refetch: If True, the dataset will be downloaded even if it
-		already exists.
+		already exists. The raw archives, the image caches, and the base sets
+		are all removed first.
 		"""
 		
 		super(MNIST, self).fetch(refetch=refetch, extract=False,
@@ -170,57 +196,226 @@ class MNIST(BaseDataset):
 		self._save_base(refetch)
 		self._get_unique_labels()
 		
-	def _load(self, x_path, y_path, ndims=1):
+	def load_raw(self, n_train, n_test):
 		"""
-		Load the data into memory.
+		Loads a reduced dataset directly from the raw data, without using the
+		base datasets. Only the first n_train and n_test occurrences of each
+		label are kept, so the images that would be discarded are never
+		stored. The result is the same as loading the base dataset and calling
+		"reduce_dataset" with normalize set to True, including the label
+		properties, which describe the full dataset. If the number of
+		samples is set to 0, that set will be empty. The data must have
+		already been fetched.
+		
+		@param n_train: The number of training samples of each label to use.
+		
+		@param n_test: The number of test samples of each label to use.
+		
+		@raise InvalidSelectionAmount: Raised if the number of desired items to
+		select is larger than the total number of available items.
+		
+		@raise UnknownTestLabels: Raised if the test set contains labels that
+		are not in the training set.
+		"""
+		
+		# Validate the selection against the full labels before anything is
+		# changed, as "reduce_dataset" would
+		y_train = self._load_labels(self.train_y_path)
+		y_test  = self._load_labels(self.test_y_path)
+		labels, train_counts     = self._count_labels(y_train)
+		test_labels, test_counts = self._count_labels(y_test)
+		unknown = set(test_labels).difference(labels)
+		if unknown:
+			raise UnknownTestLabels(sorted(unknown))
+		test_counts    = dict(zip(test_labels, test_counts))
+		min_test_count = min(test_counts.get(lbl, 0) for lbl in labels)
+		n_train = int(n_train)
+		n_test  = int(n_test)
+		if n_train > min(train_counts) or n_train < 0:
+			raise InvalidSelectionAmount(n_train, min(train_counts), 'train')
+		if n_test > min_test_count or n_test < 0:
+			raise InvalidSelectionAmount(n_test, min_test_count, 'test')
+		
+		# Only load the images of the selected samples
+		if n_train > 0:
+			train_idx = self._first_per_label(y_train, n_train, labels)
+			x_train   = self._load_images(self.train_x_path, self.ndims,
+				train_idx)
+		if n_test > 0:
+			test_idx = self._first_per_label(y_test, n_test, labels)
+			x_test   = self._load_images(self.test_x_path, self.ndims,
+				test_idx)
+		
+		# Extract properties about the full data and keep the selection
+		self.y_train, self.y_test = y_train, y_test
+		self._get_unique_labels()
+		if n_train > 0:
+			self.x_train = x_train; self.y_train = y_train[train_idx]
+		else:
+			self.x_train = np.array([]); self.y_train = np.array([])
+		if n_test > 0:
+			self.x_test = x_test; self.y_test = y_test[test_idx]
+		else:
+			self.x_test = np.array([]); self.y_test = np.array([])
+		self._pack_images()
+	
+	def _read_into(self, f, path, data):
+		"""
+		Read from a file until the array is full.
+		
+		@param f: The file to read from.
 		
-		@param x_path: The path to the x data (the images).
+		@param path: The path to the file.
+		
+		@param data: The contiguous array to fill.
+		
+		@raise TruncatedFile: Raised if the file is missing data.
+		"""
 		
-		@param y_path: The path to the y data (the labels).
+		view = memoryview(data.reshape(-1))
+		n    = 0
+		while n < data.nbytes:
+			nread = f.readinto(view[n:n + IO_BUFFER_SIZE])
+			if nread == 0:
+				raise TruncatedFile(path, data.nbytes, n)
+			n += nread
+	
+	def _load_all(self, ndims=1):
+		"""
+		Load the training and testing data into memory. The four files are
+		decompressed in parallel, as zlib releases the GIL.
 		
 		@param ndims: The number of dimensions to use (1D or 2D only!).
 		
-		@returns: A tuple containing the x data and its corresponding labels.
+		@returns: A tuple containing the training data, the training labels,
+		the testing data, and the testing labels.
 		
 		@raise WrongMagicNumber: Raised if a magic number mismatch occurs.
+		
+		@raise TruncatedFile: Raised if the file is missing data.
 		"""
 		
-		# Read the image into memory
-		dt = np.dtype('uint8')
-		with gzip.open(x_path, 'rb') as f:
-			magic, size, rows, cols = struct.unpack(">IIII", f.read(16))
-			if magic != 2051:
-				raise WrongMagicNumber(x_path, 2051, magic)
-			data = np.frombuffer(f.read(), dtype=dt)
+		loads = ((self._load_images, (self.train_x_path, ndims)),
+			(self._load_labels, (self.train_y_path,)),
+			(self._load_images, (self.test_x_path, ndims)),
+			(self._load_labels, (self.test_y_path,)))
+		
+		n_workers = min(cpu_count(), len(loads))
+		if n_workers == 1:
+			return tuple(load(*args) for load, args in loads)
+		
+		pool = ThreadPool(n_workers)
+		try:
+			results = [pool.apply_async(load, args) for load, args in loads]
+			return tuple(result.get() for result in results)
+		finally:
+			pool.close()
+	
+	def _load_images(self, x_path, ndims=1, idx=None):
+		"""
+		Load the images into memory. The decompressed images are cached in a
+		NumPy (.npy) file next to the archive. On subsequent loads the cache is
+		memory-mapped, so only the images that are accessed are read from
+		disk.
+		
+		@param x_path: The path to the images.
+		
+		@param ndims: The number of dimensions to use (1D or 2D only!).
+		
+		@param idx: The sorted indices of the images to load. If None, all of
+		the images are loaded.
+		
+		@returns: The images.
+		
+		@raise WrongMagicNumber: Raised if a magic number mismatch occurs.
+		
+		@raise TruncatedFile: Raised if the file is missing data.
+		"""
 		
+		dt       = np.dtype('uint8')
+		npy_path = os.path.splitext(x_path)[0] + '.npy'
+		if os.path.exists(npy_path):
+			# Map the cached images
+			data = np.load(npy_path, mmap_mode='r')
+			size, rows, cols = data.shape
+			if idx is not None:
+				# Copy the selection out of the read-only mapping
+				data = np.array(data[idx])
+		else:
+			with gzip.open(x_path, 'rb') as f:
+				magic, size, rows, cols = IMAGE_HEADER.unpack(
+					f.read(IMAGE_HEADER.size))
+				if magic != 2051:
+					raise WrongMagicNumber(x_path, 2051, magic)
+				
+				if idx is None:
+					# Read the images into memory, decompressing them directly
+					# into the final buffer
+					data = np.empty(size * rows * cols, dtype=dt)
+					self._read_into(f, x_path, data)
+				else:
+					# Only decompress up to the last selected image, keeping
+					# just the selected images
+					data  = np.empty((len(idx), rows * cols), dtype=dt)
+					chunk = max(1, IO_BUFFER_SIZE // (rows * cols))
+					buf   = np.empty((chunk, rows * cols), dtype=dt)
+					stop  = idx[-1] + 1 if len(idx) > 0 else 0
+					k     = 0
+					for start in xrange(0, stop, chunk):
+						n = min(chunk, stop - start)
+						self._read_into(f, x_path, buf[:n])
+						end = np.searchsorted(idx, start + n)
+						data[k:end] = buf[idx[k:end] - start]
+						k = end
+			
+			# Cache the images, making sure that a partial file is never used
+			if idx is None:
+				tmp_path = npy_path + '.tmp'
+				with open(tmp_path, 'wb', IO_BUFFER_SIZE) as f:
+					np.save(f, data.reshape((size, rows, cols)))
+				replace_file(tmp_path, npy_path)
+		
+		# The images are stored contiguously, so a reshape gives the desired
+		# representation without copying any data
 		if ndims == 1:
 			# 1D representation
-			img = np.zeros((size, rows * cols), dtype=dt)
-			for i in xrange(size):
-				img[i] = data[i * rows * cols:(i + 1) * rows * cols]
+			return data.reshape((-1, rows * cols))
 		else:
 			# 2D representation
-			img = np.zeros((size, rows, cols), dtype=dt)
-			for i in xrange(size):
-				for r in xrange(rows):
-					img[i][r] = data[i * rows * cols + r * cols:i * rows * cols
-						+ r * cols + cols]
+			return data.reshape((-1, rows, cols))
+	
+	def _load_labels(self, y_path):
+		"""
+		Load the labels into memory.
+		
+		@param y_path: The path to the labels.
+		
+		@returns: The labels.
 		
-		# Read the labels into memory
+		@raise WrongMagicNumber: Raised if a magic number mismatch occurs.
+		
+		@raise TruncatedFile: Raised if the file is missing data.
+		"""
+		
+		# Decompress the labels directly into their array
 		with gzip.open(y_path, 'rb') as f:
-			magic, size = struct.unpack(">II", f.read(8))
+			magic, size = LABEL_HEADER.unpack(f.read(LABEL_HEADER.size))
 			if magic != 2049:
-				raise WrongMagicNumber(x_path, 2049, magic)
-			lbl = np.frombuffer(f.read(), dtype=dt)
+				raise WrongMagicNumber(y_path, 2049, magic)
+			
+			labels = np.empty(size, dtype=np.uint8)
+			self._read_into(f, y_path, labels)
 		
-		return img, lbl
+		return labels
 	
 	def _save_base(self, refetch=False):
 		"""
-		Saves the training and testing images and labels into memory.
+		Loads the base set for the current number of dimensions, creating it
+		if it does not exist. The base set for the other number of dimensions
+		is only created when it is first loaded.
 		
-		@param refetch: If True, the dataset will be downloaded even if it
-		already exists.
+		@param refetch: If True, all existing base sets are removed first, so
+		that the base set is recreated from the raw data.
 		"""
 		
 		# Delete any unwanted data
@@ -230,30 +425,77 @@ class MNIST(BaseDataset):
 			except OSError:
 				pass
 		
-		path_2d = os.path.join(self.base_dir, '2d_base.pkl')
-		path_1d = os.path.join(self.base_dir, '1d_base.pkl')
+		# Load the base set, creating it if necessary
+		self.load()
+	
+	def _dump_base(self):
+		"""
+		Creates the base set for the current number of dimensions.
+		"""
 		
-		if self.ndims == 1:
-			p = (path_2d, 2, path_1d, 1)
-		else:
-			p = (path_1d, 1, path_2d, 2)
-		
-		if not os.path.exists(p[0]):			
-			self.x_train, self.y_train =                                      \
-				self._load(self.train_x_path, self.train_y_path, p[1])
-			self.x_test, self.y_test =                                        \
-				self._load(self.test_x_path, self.test_y_path, p[1])
-			self.dump_pkl(p[0])
-			
-		if not os.path.exists(p[2]):			
-			self.x_train, self.y_train =                                      \
-				self._load(self.train_x_path, self.train_y_path, p[3])
-			self.x_test, self.y_test =                                        \
-				self._load(self.test_x_path, self.test_y_path, p[3])
-			self.dump_pkl(p[2])
+		self.x_train, self.y_train, self.x_test, self.y_test =                \
+			self._load_all(self.ndims)
+		self.dump_pkl(self.default_set)
+	
+	def load(self, name=None, mmap_mode=None):
+		"""
+		Loads the saved data. The base set for the current number of
+		dimensions is created the first time that it is needed. If the images
+		are to be packed, the base set is packed after it is loaded. User saves
+		are loaded exactly as they were saved.
+		
+		@param name: The name of the saved data to load. If None, the default
+		base set will be used.
+		
+		@param mmap_mode: If not None, the data will be memory-mapped using
+		this mode (e.g. 'r') instead of being read into memory. This only
+		applies to uncompressed saves.
+		
+		@raise InvalidSavedDataset: Raised if the saved dataset does not exist.
+		"""
+		
+		try:
+			super(MNIST, self).load(name, mmap_mode)
+		except IOError, e:
+			# Create the missing base set and try again
+			if name is not None or e.errno != errno.ENOENT:
+				raise
+			self._dump_base()
+			super(MNIST, self).load(name, mmap_mode)
+		if name is None:
+			self._pack_images()
+	
+	def _pack_images(self):
+		"""
+		Binarizes and packs the images into bits, if the images are to be
+		packed. Empty and already packed images are left as they are.
+		"""
+		
+		if self.pack_bits:
+			if self.x_train.ndim > 1 and not self._is_packed(self.x_train):
+				self.x_train = np.packbits(self.x_train >= 128, axis=-1)
+			if self.x_test.ndim > 1 and not self._is_packed(self.x_test):
+				self.x_test = np.packbits(self.x_test >= 128, axis=-1)
+	
+	def _is_packed(self, x):
+		"""
+		Determines whether the images are packed into bits, based on their
+		shape.
+		
+		@param x: The images.
+		
+		@return: True if the images are packed, otherwise False.
+		"""
+		
+		if x.ndim == 2:
+			width = IMAGE_SHAPE[0] * IMAGE_SHAPE[1]
+		elif x.ndim == 3:
+			width = IMAGE_SHAPE[1]
 		else:
-			self.load()
-
+			return False
+		
+		return x.dtype == np.uint8 and x.shape[-1] == (width + 7) // 8
+	
 	def dump_csv(self, out_dir, make_header=True):
 		"""
 		Output the data to CSV files. This is only supported if the data is
@@ -277,20 +519,28 @@ class MNIST(BaseDataset):
 		if self.ndims == 2:
 			raise InvalidCSVDimensions()
 		
-		# Build the header
-		if make_header:
-			header = ['label'] + ['pixel_{0}'.format(x) for x in
-					xrange(self.x_train.shape[1])]
-		else:
+		# Unpack any packed images, writing the bits as the pixel values
+		n_pixels = len(CSV_HEADER) - 1
+		x_train, x_test = [np.unpackbits(x, axis=1)[:, :n_pixels] if
+			self._is_packed(x) else x for x in (self.x_train, self.x_test)]
+		
+		# Build the header, reusing the prebuilt one for the standard size. An
+		# empty set has no width, so the standard size is assumed.
+		if not make_header:
 			header = []
+		elif x_train.ndim != 2 or x_train.shape[1] == n_pixels:
+			header = CSV_HEADER
+		else:
+			header = ['label'] + ['pixel_%d' % x for x in
+				xrange(x_train.shape[1])]
 		
 		# Initialize path names
 		train_path = os.path.join(out_dir, 'train.csv')
 		test_path  = os.path.join(out_dir, 'test.csv')
 		
 		# Create the CSV files
-		self._csv_dump(train_path, header, self.x_train, self.y_train)
-		self._csv_dump(test_path, header, self.x_test, self.y_test)
+		self._csv_dump(train_path, header, x_train, self.y_train)
+		self._csv_dump(test_path, header, x_test, self.y_test)
 
 ###############################################################################
 ########## Example Usage
@@ -314,10 +564,9 @@ def run_parse_example(out_dir):
 	mnist.dump_pkl(os.path.join(out_dir, '1d_mnist.pkl'))
 	mnist.save('1d_100')
 	
-	# 2D example
+	# 2D example, loading only the selected samples from the raw data
 	mnist = MNIST(2)
-	mnist.load()
-	mnist.reduce_dataset(train_samples, train_samples * 0.2)
+	mnist.load_raw(train_samples, train_samples * 0.2)
 	mnist.dump_pkl(os.path.join(out_dir, '2d_mnist.pkl'))
 	mnist.save('2d_100')
 